@@ -1,8 +1,18 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import hashlib
 import io
+import json
 import os
-from PIL import Image
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from PIL import Image, ImageOps
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from azure.core.credentials import AzureKeyCredential
 from azure.ai.formrecognizer import DocumentAnalysisClient
 
@@ -73,20 +83,126 @@ if not AZURE_ENDPOINT or not AZURE_KEY:
     """)
     st.stop()
 
+# Reuse one Azure client across reruns - construction opens a new HTTPS
+# pipeline each time, and caching it lets the connection pool be reused
+@st.cache_resource
+def get_client(endpoint, key):
+    return DocumentAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key))
+
+# Shared worker pool for running Azure calls off the script thread;
+# sized to the default Form Recognizer quota of 15 TPS
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=15)
+
+# Submit work to the pool with the Streamlit script-run context attached,
+# so cached functions behave normally in worker threads
+def submit_with_ctx(fn, *args):
+    ctx = get_script_run_ctx()
+    def _run(*a):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*a)
+    return get_executor().submit(_run, *args)
+
+# 🚧 MAINTENANCE MODE - Azure processing disabled by default to avoid charges
+# Set MAINTENANCE_MODE=0 in the environment to re-enable real parsing
+MAINTENANCE_MODE = os.getenv("MAINTENANCE_MODE", "1") == "1"
+
+def show_sample():
+    """Maintenance-mode stand-in for the real results section."""
+    st.warning("🚧 **Maintenance Mode**: Azure Form Recognizer processing is temporarily disabled to avoid charges. The app UI is working, but receipt parsing is paused.")
+    st.info("💡 You can still test the upload functionality and UI. Processing will be re-enabled when needed.")
+
+    # Show a sample CSV for demonstration
+    st.subheader("3️⃣ Results")
+    st.info("📋 This would normally show the extracted receipt data. Here's a sample of what the output would look like:")
+
+    # Create sample data matching the template
+    sample_data = {
+        "Date": ["2024-01-15", "2024-01-15", "2024-01-15"],
+        "Merchant": ["Sample Store", "Sample Store", "Sample Store"],
+        "Item": ["Coffee", "Sandwich", "Tax"],
+        "Price": [4.50, 8.95, 1.25],
+        "Total": ["", "", 14.70]
+    }
+
+    sample_df = pd.DataFrame(sample_data)
+    st.dataframe(sample_df, use_container_width=True)
+
+    # Provide download of sample data
+    csv = sample_df.to_csv(index=False).encode("utf-8")
+    st.download_button(
+        label="📥 Download Sample CSV",
+        data=csv,
+        file_name="sample_receipt.csv",
+        mime="text/csv",
+        use_container_width=True,
+        help="This is sample data - in normal mode, this would contain your actual receipt data"
+    )
+
+# Merchant-name fallback heuristics, compiled once at import so the
+# per-line scan runs in C instead of chained Python string methods
+_NON_MERCHANT = re.compile(r'(?i)\b(phone|tel|address|street|ave|rd|blvd)\b')
+_NUMERIC_LINE = re.compile(r'^[\d./-]+$')
+
+def _plain_value(value):
+    """Convert an SDK field value into a plain Python value."""
+    if hasattr(value, "amount"):  # CurrencyValue
+        return value.amount
+    if hasattr(value, "isoformat"):  # date/datetime
+        return value.isoformat()
+    return value
+
+def _to_plain_dict(result):
+    """Flatten an AnalyzeResult into plain dicts so it can be cached."""
+    fields = {}
+    items = []
+    if result.documents:
+        for name, field in result.documents[0].fields.items():
+            if name == "Items":
+                for item in field.value or []:
+                    items.append({k: _plain_value(f.value) for k, f in item.value.items()})
+            else:
+                fields[name] = _plain_value(field.value)
+    return {"fields": fields, "items": items, "content": result.content}
+
+# Content-addressed disk cache so previously analyzed receipts survive
+# app restarts (st.cache_data lives in process memory only)
+CACHE_DIR = Path.home() / ".cache" / "receipt-parsing"
+CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Cache on the image bytes so reruns with the same receipt don't pay
+# for another multi-second Azure call; memory is L1, disk is L2
+@st.cache_data(show_spinner="🔍 Analyzing receipt...")
+def analyze_receipt(img_bytes: bytes):
+    key = hashlib.sha256(img_bytes).hexdigest()
+    path = CACHE_DIR / f"{key}.json"
+    if path.exists():
+        return json.loads(path.read_text())
+    poller = get_client(AZURE_ENDPOINT, AZURE_KEY).begin_analyze_document("prebuilt-receipt", img_bytes)
+    res = _to_plain_dict(poller.result())
+    path.write_text(json.dumps(res))
+    return res
+
+# Cache the template parse on its raw bytes so reruns skip pd.read_csv
+@st.cache_data
+def load_template(data: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(data))
+
 # 1. Upload CSV template
 st.subheader("1️⃣ Upload Template")
 tpl = st.file_uploader("Upload CSV template", type="csv", help="Upload your CSV template to define the output structure")
 if not tpl:
     st.info("👆 Please upload a CSV template to get started")
     st.stop()
-df_tpl = pd.read_csv(tpl)
+df_tpl = load_template(tpl.getvalue())
 st.success(f"✅ Template loaded with {len(df_tpl.columns)} columns")
 
-# 2. Capture or upload receipt image
-st.subheader("2️⃣ Add Receipt")
+# 2. Capture or upload receipt images
+st.subheader("2️⃣ Add Receipts")
 
 # Upload option is always visible
-img_upload = st.file_uploader("📁 Upload Image", type=["jpg","png","jpeg"])
+img_uploads = st.file_uploader("📁 Upload Images", type=["jpg","png","jpeg"], accept_multiple_files=True)
 
 # Camera option with toggle
 use_camera = st.checkbox("📸 Use Camera Instead", help="Toggle to show camera input")
@@ -94,59 +210,195 @@ img_camera = None
 if use_camera:
     img_camera = st.camera_input("� Take Photo")
 
-img = img_camera or img_upload
-if not img:
-    st.info("📱 Upload a receipt image or use the camera to continue")
+imgs = list(img_uploads or [])
+if img_camera:
+    imgs.append(img_camera)
+if not imgs:
+    st.info("📱 Upload receipt images or use the camera to continue")
     st.stop()
 
-# Display the uploaded/captured image as a thumbnail with expandable view
-col1, col2 = st.columns([1, 3])
-with col1:
-    st.image(img, caption="📸 Receipt", width=150)
-with col2:
-    with st.expander("🔍 View Full Size Image"):
-        st.image(img, caption="📸 Receipt Image", use_container_width=True)
+# Downscale before uploading - raw camera photos are often 3-10 MB and the
+# upload leg dominates latency; ~1600px long edge keeps OCR accuracy intact
+def shrink_image(raw: bytes) -> bytes:
+    pil = Image.open(io.BytesIO(raw))
+    # Phone photos often carry orientation as EXIF metadata; apply it to
+    # the pixels since the re-encode below drops the EXIF block
+    pil = ImageOps.exif_transpose(pil)
+    pil.thumbnail((1600, 1600), Image.LANCZOS)
+    buf = io.BytesIO()
+    pil.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+    return buf.getvalue()
 
 # 3. Read image bytes
-if hasattr(img, "read"):
-    img_bytes = img.read()
-else:
-    buf = io.BytesIO()
-    Image.open(img).save(buf, format="JPEG")
-    img_bytes = buf.getvalue()
+bytes_list = []
+for img in imgs:
+    if hasattr(img, "read"):
+        raw_bytes = img.read()
+    else:
+        # Path-like input: read the bytes as-is; shrink_image below does
+        # the only decode/re-encode pass we need
+        with open(img, "rb") as f:
+            raw_bytes = f.read()
+    bytes_list.append(shrink_image(raw_bytes))
+
+# Fan the Azure calls out right away so they run concurrently and the
+# network wait overlaps with rendering the previews below
+analyze_futures = []
+if not MAINTENANCE_MODE:
+    analyze_futures = [submit_with_ctx(analyze_receipt, b) for b in bytes_list]
 
-# 🚧 MAINTENANCE MODE - Azure processing temporarily disabled to avoid charges
-st.warning("🚧 **Maintenance Mode**: Azure Form Recognizer processing is temporarily disabled to avoid charges. The app UI is working, but receipt parsing is paused.")
-st.info("💡 You can still test the upload functionality and UI. Processing will be re-enabled when needed.")
+# Display each receipt as a thumbnail with expandable view. Both calls
+# get the same downscaled bytes object, so Streamlit's media manager
+# serves one cached asset instead of reprocessing the multi-MB original
+# for the thumbnail and again for the expander
+for preview_bytes in bytes_list:
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        st.image(preview_bytes, caption="📸 Receipt", width=150)
+    with col2:
+        with st.expander("🔍 View Full Size Image"):
+            st.image(preview_bytes, caption="📸 Receipt Image", use_container_width=True)
+
+if MAINTENANCE_MODE:
+    show_sample()
+    st.stop()  # Stop execution here to avoid running Azure code
+
+# 4. Collect the Azure results (started before the previews rendered)
+results = [f.result() for f in analyze_futures]
+
+# 5. Build output columns matching the template, one batch of rows per
+# receipt. Columnar lists avoid allocating a dict per row and give
+# pd.DataFrame a single type-inference pass at the end.
+data = {col: [] for col in df_tpl.columns}
+is_summary = []
+_KNOWN_COLS = {"Date", "Merchant", "Item", "Quantity", "Unit Price", "Price", "Total"}
+extra_cols = [col for col in df_tpl.columns if col not in _KNOWN_COLS]
+
+# Resolve template-column membership once instead of per item
+tpl_cols = set(df_tpl.columns)
+has_date = "Date" in tpl_cols
+has_merchant = "Merchant" in tpl_cols
+has_item = "Item" in tpl_cols
+has_qty = "Quantity" in tpl_cols
+has_unit = "Unit Price" in tpl_cols
+has_price = "Price" in tpl_cols
+has_total = "Total" in tpl_cols
+
+for res in results:
+    fields = res["fields"]
+
+    merchant_name = fields.get("MerchantName")
+    if not merchant_name:
+        # Fallback: guess the merchant from the first few lines of raw text
+        for line in islice(res["content"].splitlines(), 5):
+            line = line.strip()
+            if len(line) > 2 and not _NUMERIC_LINE.match(line) and not _NON_MERCHANT.search(line):
+                merchant_name = line
+                break
+
+    transaction_date = fields.get("TransactionDate")
+
+    for item_data in res["items"]:
+        # Raw values only; numeric coercion and label formatting happen
+        # vectorized after the DataFrame is built
+        if has_date:
+            data["Date"].append(str(transaction_date) if transaction_date else "")
+        if has_merchant:
+            data["Merchant"].append(merchant_name or "")
+        if has_item:
+            data["Item"].append(item_data.get("Description") or "Unknown Item")
+        if has_qty:
+            data["Quantity"].append(item_data.get("Quantity"))
+        if has_unit:
+            data["Unit Price"].append(item_data.get("Price"))
+        if has_price:
+            data["Price"].append(item_data.get("TotalPrice"))
+        if has_total:
+            data["Total"].append(pd.NA)
+        for col in extra_cols:
+            data[col].append("")
+        is_summary.append(False)
+
+    # Add a summary row with the receipt total
+    receipt_total = fields.get("Total")
+    if receipt_total is not None and has_total:
+        if has_date:
+            data["Date"].append(str(transaction_date) if transaction_date else "")
+        if has_merchant:
+            data["Merchant"].append(merchant_name or "")
+        if has_item:
+            data["Item"].append("TOTAL")
+        if has_qty:
+            data["Quantity"].append(pd.NA)
+        if has_unit:
+            data["Unit Price"].append(pd.NA)
+        if has_price:
+            data["Price"].append(pd.NA)
+        data["Total"].append(receipt_total)
+        for col in extra_cols:
+            data[col].append("")
+        is_summary.append(True)
+
+out_df = pd.DataFrame(data)
+is_summary = pd.Series(is_summary, dtype=bool)
+
+# Clean up numeric columns to avoid Arrow conversion issues. One
+# to_numeric pass per column replaces the per-item try/except float()
+# casts the loop used to do.
+for col in ["Quantity", "Unit Price", "Price", "Total"]:
+    if col in out_df.columns:
+        out_df[col] = pd.to_numeric(out_df[col], errors="coerce")
+
+# Default missing quantities to 1 and derive missing line totals from
+# unit price x quantity (summary rows keep their blanks)
+if has_qty:
+    out_df.loc[~is_summary & out_df["Quantity"].isna(), "Quantity"] = 1
+if has_price and has_unit and has_qty:
+    derived = out_df["Unit Price"] * out_df["Quantity"]
+    out_df["Price"] = out_df["Price"].where(out_df["Price"].notna() | is_summary, derived)
+
+# Format multi-quantity labels like "2x Item (@$1.50 each)" in one pass
+if has_item and has_qty:
+    multi = ~is_summary & out_df["Quantity"].notna() & out_df["Quantity"].ne(1)
+    if multi.any():
+        labels = out_df.loc[multi, "Quantity"].astype(int).astype(str) + "x " + out_df.loc[multi, "Item"]
+        if has_unit:
+            unit = out_df.loc[multi, "Unit Price"]
+            priced = unit.notna()
+            labels[priced] = labels[priced] + " (@$" + unit[priced].map("{:.2f}".format) + " each)"
+        out_df.loc[multi, "Item"] = labels
+
+# Debug info for troubleshooting extraction issues. Gated behind a
+# sidebar toggle because a collapsed expander still executes its body -
+# and all these st.write serializations - on every rerun.
+def show_debug_info():
+    with st.expander("🔍 Debug Info", expanded=True):
+        for i, res in enumerate(results, 1):
+            st.write(f"**Receipt {i} - raw fields detected:**")
+            for field_name, field_value in res["fields"].items():
+                st.write(f"- {field_name}: {field_value}")
+            st.write(f"**Receipt {i} - raw text (first 500 chars):**")
+            st.text(res["content"][:500])
+
+if st.sidebar.checkbox("🔍 Show debug info", value=False):
+    show_debug_info()
+
+# 6. Show results and offer CSV download. Serialize to Arrow once: the
+# same table backs st.dataframe (which converts to Arrow internally
+# anyway) and the CSV download, and pyarrow's CSV writer is several
+# times faster than the pandas one.
+table = pa.Table.from_pandas(out_df, preserve_index=False)
+csv_buf = io.BytesIO()
+pa_csv.write_csv(table, csv_buf)
+csv = csv_buf.getvalue()
 
-# Show a sample CSV for demonstration
 st.subheader("3️⃣ Results")
-st.info("📋 This would normally show the extracted receipt data. Here's a sample of what the output would look like:")
-
-# Create sample data matching the template
-sample_data = {
-    "Date": ["2024-01-15", "2024-01-15", "2024-01-15"],
-    "Merchant": ["Sample Store", "Sample Store", "Sample Store"], 
-    "Item": ["Coffee", "Sandwich", "Tax"],
-    "Price": [4.50, 8.95, 1.25],
-    "Total": ["", "", 14.70]
-}
-
-sample_df = pd.DataFrame(sample_data)
-st.dataframe(sample_df, use_container_width=True)
-
-# Provide download of sample data
-csv = sample_df.to_csv(index=False).encode("utf-8")
+st.dataframe(table, use_container_width=True)
 st.download_button(
-    label="📥 Download Sample CSV",
+    label="📥 Download CSV",
     data=csv,
-    file_name="sample_receipt.csv",
+    file_name="receipt.csv",
     mime="text/csv",
-    use_container_width=True,
-    help="This is sample data - in normal mode, this would contain your actual receipt data"
+    use_container_width=True
 )
 
-st.stop()  # Stop execution here to avoid running Azure code
-
-
-